@@ -1,7 +1,84 @@
+import asyncio
+import codecs
+import collections
+import functools
+import http.cookiejar
+import importlib.util
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# maximum number of requests in flight at once when sending through requests.
+MAX_WORKERS = 32
+# maximum number of open connections when sending through httpx.
+MAX_CONNECTIONS = 64
+# chunk size for comparing samples with responses.
+COMPARE_CHUNK = 64 * 1024
+# HTTP/2 is used by httpx only if its optional h2 dependency is installed.
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+# existing request and sample files, see Test._index_dirs.
+_Files = collections.namedtuple("_Files", "params req_content sample_cnt sample_snh")
+# all tests in name order, the skipped ones among them, with the files they need, see Test.run.
+_Index = collections.namedtuple(
+    "_Index", "names skipped params req_content sample_cnt matchers")
+
+
+def _loads(s):
+    """Parses JSON, with orjson if it is available.
+
+    :param s: JSON text."""
+
+    if orjson is not None:
+        return orjson.loads(s)
+
+    return json.loads(s)
+
+
+# file modification time and size are part of the key, so edited files are reloaded.
+@functools.lru_cache(maxsize=4096)
+def _load_text(fn, mtime_ns, size, encoding):
+    """Reads and caches file contents.
+
+    :param fn: source file name.
+    :param mtime_ns: file modification time.
+    :param size: file size.
+    :param encoding: file open encoding."""
+
+    with open(fn, encoding=encoding) as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=4096)
+def _load_prm(fn, mtime_ns, size, encoding):
+    """Reads, parses and caches request parameters.
+
+    :param fn: source file name.
+    :param mtime_ns: file modification time.
+    :param size: file size.
+    :param encoding: file open encoding.
+    :rtype: tuple of request type, URI and headers"""
+
+    with open(fn, encoding=encoding) as f:
+        j = _loads(f.read())
+
+    return j["Method"], j["URI"], j.get("Headers")
 
 
 class Test:
@@ -16,14 +93,19 @@ class Test:
         "errors_dir",
     ).run()"""
 
-    def __init__(self, responses_dir, samples_dir, requests_dir, errors_dir, encoding="utf-8"):
+    def __init__(self, responses_dir, samples_dir, requests_dir, errors_dir,
+            encoding="utf-8", session=None, backend="requests"):
         """Class initialization.
 
         :param responses_dir: directory for restful responses.
         :param samples_dir: directory for samples.
         :param requests_dir: directory for restful requests.
         :param errors_dir: directory for error output file.
-        :param encoding: file open encoding."""
+        :param encoding: file open encoding.
+        :param session: requests session to send requests with, a pooled session by default.
+        :param backend: "requests" to send requests from a pool of threads, or "httpx" to send
+            them asynchronously with httpx. The thread pool is still used if run is called
+            while an event loop is running."""
 
         # since init is the only place where this function will be used.
         def force_dir(directory):
@@ -38,20 +120,53 @@ class Test:
         self._requests = requests_dir
         force_dir(errors_dir)
         self._errors = errors_dir
+        # directory prefixes with a trailing separator, file names are built by concatenation.
+        self._res_prefix = os.path.join(responses_dir, "")
+        self._smp_prefix = os.path.join(samples_dir, "")
+        self._req_prefix = os.path.join(requests_dir, "")
+        self._errors_fn = os.path.join(errors_dir, "errors.txt")
+        self._state_fn = os.path.join(errors_dir, ".state.json")
         self._encoding = encoding
-
-    def _get_request_content(self, name):
+        utf8 = codecs.lookup(encoding).name == "utf-8"
+        # orjson always produces UTF-8, so it can only be used for UTF-8 files.
+        self._use_orjson = orjson is not None and utf8
+        # compact encoder, built once and reused for every response. It writes UTF-8 text
+        # unescaped like orjson does, other encodings might not hold every character.
+        self._encode = json.JSONEncoder(
+            default=dict, sort_keys=True, separators=(",", ":"), ensure_ascii=not utf8).encode
+        if backend not in ("requests", "httpx"):
+            raise ValueError("unknown backend: {}".format(backend))
+        if backend == "httpx" and httpx is None:
+            raise ImportError("httpx backend requires httpx to be installed")
+        self._use_httpx = backend == "httpx"
+        # one session for all tests, so connections are kept alive and reused.
+        if session is None:
+            session = requests.Session()
+            # send only the headers given in request parameters, as a bare request would.
+            session.headers.clear()
+            # do not keep cookies between tests, each one is sent as by a fresh session.
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self._session = session
+        # failures are collected during a run and written to errors.txt at its end.
+        self._err_buf = []
+        self._err_lock = threading.Lock()
+        # tests passed during a run, recorded to skip them next time while unchanged.
+        self._passed = []
+
+    def _get_request_content(self, name, req_content):
         """Reads request contents from a file.
 
-        :param name: destination file name."""
+        :param name: destination file name.
+        :param req_content: existing request content files, see _scan."""
 
-        # complete file name.
-        fn = os.path.join(self._requests, name + ".cnt")
         # GET requests usually don't have content part.
-        if not os.path.exists(fn):
+        if name not in req_content:
             return ""
         # return contents.
-        return self._read_from_file(fn)
+        return self._read_cached(self._req_prefix + name + ".cnt", _load_text, req_content[name])
 
     def _save_to_file(self, fn, data, mode="w"):
         """Writes given data to a file.
@@ -63,6 +178,40 @@ class Test:
         with open(fn, mode, encoding=self._encoding) as r:
             r.write(data)
 
+    @staticmethod
+    def _save_batch(pairs):
+        """Writes several files in one go. Each file is written to a temporary file and moved
+        over the destination, so readers never see a partially written file.
+
+        All files are opened first and then written back to back, so the writes are not
+        interleaved with opening and closing.
+
+        :param pairs: sequence of destination file name and bytes to write."""
+
+        fds = []
+        written = False
+        try:
+            for fn, _ in pairs:
+                # same permissions as open() gives, i.e. as allowed by umask.
+                fds.append(os.open(fn + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+            for fd, (_, data) in zip(fds, pairs):
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            written = True
+        finally:
+            for fd in fds:
+                os.close(fd)
+            # do not leave temporary files behind if any of them could not be written.
+            if not written:
+                for (fn, _), _ in zip(pairs, fds):
+                    try:
+                        os.remove(fn + ".tmp")
+                    except OSError:
+                        pass
+        for fn, _ in pairs:
+            os.replace(fn + ".tmp", fn)
+
     def _read_from_file(self, fn):
         """Reads data from a file.
 
@@ -71,146 +220,489 @@ class Test:
         with open(fn, encoding=self._encoding) as f:
             return f.read()
 
-    def _send_request(self, method, uri, headers, content, name):
-        """Forms and sends request to given handler and write response to a file
+    def _read_cached(self, fn, loader, st):
+        """Reads a file through a cached loader, reloading it only if it has changed.
+
+        :param fn: source file name.
+        :param loader: cached loader function.
+        :param st: stat result of the file taken when its directory was scanned."""
+
+        return loader(fn, st.st_mtime_ns, st.st_size, self._encoding)
+
+    def _file_equals(self, fn, data):
+        """Compares file contents with given bytes, chunk by chunk.
+
+        Stops at the first differing chunk, so the file is not read as a whole.
+
+        :param fn: file name.
+        :param data: bytes to compare with."""
+
+        with open(fn, "rb") as f:
+            # files of a different size can not be equal.
+            if os.fstat(f.fileno()).st_size != len(data):
+                return False
+            offset = 0
+            while True:
+                chunk = f.read(COMPARE_CHUNK)
+                if not chunk:
+                    break
+                # bytes are compared with memcmp, memoryviews would be compared item by item.
+                if chunk != data[offset:offset + len(chunk)]:
+                    return False
+                offset += len(chunk)
+
+        return offset == len(data)
+
+    def _dumps(self, obj):
+        """Serializes given object to compact JSON bytes with sorted keys.
+
+        Mappings that are not dicts (e.g. response headers) are converted by the encoder.
+
+        :param obj: object to serialize."""
+
+        if self._use_orjson:
+            return orjson.dumps(obj, default=dict, option=orjson.OPT_SORT_KEYS)
+
+        return self._encode(obj).encode(self._encoding)
+
+    def _send_request(self, method, uri, headers, content):
+        """Forms and sends request to given handler.
 
         :param method: request method.
         :param uri: request URI.
         :param headers: request headers.
-        :param content: request content.
-        :param name: destination file name."""
-
-        # establishes connection, forms and prepares a request then sends it.
-        res = requests.Session().send(requests.Request(
-            method, uri, headers=headers, data=content).prepare())
-        res_content = res.content.decode(self._encoding)
-        # save contents and headers to a file.
-        self._save_to_file(
-            os.path.join(self._responses, name + ".cnt"),
-            res_content,
-        )
-        self._save_to_file(
-            os.path.join(self._responses, name + ".snh"),
-            json.dumps(
-                {
-                    "Status": res.status_code,
-                    "Headers": dict(res.headers),
-                },
-                indent=4,
-                sort_keys=True,
-            ),
-        )
-
-        return res.status_code, res.headers, res_content
-
-    def _check_sample_contents(self, name, res):
-        """Compares response contents with a sample.
+        :param content: request content bytes.
+        :rtype: tuple of response status, headers and contents"""
 
-        :param name: destination file name.
-        :param res: response contents."""
+        # forms and prepares a request then sends it through the shared session.
+        prepared = self._session.prepare_request(requests.Request(
+            method, uri, headers=headers, data=content))
+        res = self._session.send(prepared)
 
-        # complete file name.
-        sn = os.path.join(self._samples, name + ".cnt")
-        rn = os.path.join(self._responses, name + ".cnt")
-        # if sample not exists (i.e. first run), make it.
-        if not os.path.exists(sn):
-            self._save_to_file(sn, res)
+        return res.status_code, res.headers, res.content
 
-            return True
-        # compare result to sample, write an error if contents are not equal.
-        return self._read_from_file(sn) == self._read_from_file(rn)
+    async def _send_request_async(self, client, method, uri, headers, content):
+        """Forms and sends request to given handler with httpx.
 
-    def _check_sample_headers(self, name, status, headers):
-        """Compares response headers and status code with a sample.
+        Redirects are followed here rather than by the client, so cookies set during them are
+        kept for this request only, as requests does.
 
-        :param name: destination sample file name.
+        :param client: httpx client shared by all tests, see _run_async.
+        :param method: request method.
+        :param uri: request URI.
+        :param headers: request headers.
+        :param content: request content bytes.
+        :rtype: tuple of response status, headers and contents"""
+
+        cookies = httpx.Cookies()
+        res = await client.send(
+            client.build_request(method, uri, headers=headers, content=content or None))
+        redirects = 0
+        while res.next_request is not None:
+            redirects += 1
+            if redirects > requests.models.DEFAULT_REDIRECT_LIMIT:
+                raise httpx.TooManyRedirects(
+                    "Exceeded {} redirects.".format(requests.models.DEFAULT_REDIRECT_LIMIT),
+                    request=res.next_request)
+            cookies.extract_cookies(res)
+            cookies.set_cookie_header(res.next_request)
+            res = await client.send(res.next_request)
+        # httpx lower-cases header names, keep them as sent by the server like requests does.
+        res_headers = CaseInsensitiveDict()
+        for header, value in res.headers.raw:
+            header = header.decode(res.headers.encoding)
+            value = value.decode(res.headers.encoding)
+            if header in res_headers:
+                value = res_headers[header] + ", " + value
+            res_headers[header] = value
+
+        return res.status_code, res_headers, res.content
+
+    def _check_sample(self, name, status, headers, content, index):
+        """Compares response status, headers and contents with samples.
+
+        :param name: test name.
         :param status: response status.
-        :param headers: response headers."""
-
-        # complete file name.
-        sn = os.path.join(self._samples, name + ".snh")
-        # if sample headers file does not exist, skip the check.
-        if not os.path.exists(sn):
-            return True
-        # read request parameters.
-        j = json.loads(self._read_from_file(sn))
-        sample_status = j.get("Status")
-        sample_headers = j.get("Headers")
-
-        if sample_status is not None and sample_status != status:
-            return False
+        :param headers: response headers.
+        :param content: response contents bytes.
+        :param index: tests to run and their files, see _Index.
+        :rtype: tuple of True if the response matches samples, and whether sample headers and
+            sample contents are missing and should be made from the response"""
+
+        matchers = index.matchers
+        # compare headers first, it is cheaper than comparing contents.
+        if name in matchers and not matchers[name](status, headers):
+            return False, False, False
+        # if sample not exists (i.e. first run), make it.
+        if name not in index.sample_cnt:
+            return True, name not in matchers, True
+        # compare sample to the response in memory, it is the same as the saved response file.
+        sn = self._smp_prefix + name + ".cnt"
+        ok = self._file_equals(sn, content)
+        # samples made by earlier versions were written and compared in text mode, so fall back
+        # to a comparison that ignores line endings, see _newlines_equal.
+        if not ok:
+            with open(sn, "rb") as f:
+                ok = self._newlines_equal(f.read(), content)
 
-        if sample_headers is None:
-            return True
+        return ok, ok and name not in matchers, False
 
-        for header, value in sample_headers.items():
-            if headers.get(header) != value:
-                return False
+    @staticmethod
+    def _newlines_equal(sample, content):
+        """Compares sample and response contents like earlier versions did, reading both in text
+        mode with universal newlines.
 
-        return True
+        A sample written in text mode on Windows has every "\n" of the response stored as "\r\n",
+        so the response is also compared as if it had been written the same way.
+
+        :param sample: sample contents bytes.
+        :param content: response contents bytes."""
+
+        def universal(data):
+            """Translates line endings like text mode reading does."""
+            return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        sample = universal(sample)
+
+        return sample == universal(content) or sample == universal(content.replace(b"\n", b"\r\n"))
+
+    @staticmethod
+    def _compile_matcher(sample_status, sample_headers):
+        """Builds a function that checks response status and headers against a sample.
+
+        The sample is unpacked once here, so each check only does the comparisons it needs.
+
+        :param sample_status: expected status or None.
+        :param sample_headers: expected headers or None.
+        :rtype: function of response status and headers returning True if they match"""
+
+        if not sample_headers:
+            if sample_status is None:
+                return lambda status, headers: True
+
+            return lambda status, headers: status == sample_status
+
+        keys = tuple(sample_headers)
+        values = tuple(sample_headers.values())
+        if sample_status is None:
+            return lambda status, headers: tuple(map(headers.get, keys)) == values
+        # compare all headers in one go rather than header by header.
+        return lambda status, headers: (
+            status == sample_status and tuple(map(headers.get, keys)) == values)
+
+    def _load_sample_headers(self, names, sample_snh):
+        """Reads and parses sample headers files of tests to run once for the whole run.
+
+        :param names: names of tests to run.
+        :param sample_snh: names of existing sample headers files.
+        :rtype: dict of sample name to matcher, see _compile_matcher"""
+
+        samples = {}
+        # samples of other tests are not needed and are not read.
+        for name in filter(sample_snh.__contains__, names):
+            j = _loads(self._read_from_file(self._smp_prefix + name + ".snh"))
+            samples[name] = self._compile_matcher(j.get("Status"), j.get("Headers"))
+
+        return samples
+
+    @staticmethod
+    def _scan(directory, exts, stat=True):
+        """Lists names of files with given extensions in a directory with a single scan.
 
-    def _get_names(self):
-        """Iterates through request part files and get parameter names
+        :param directory: directory to scan.
+        :param exts: file extensions.
+        :param stat: stat every file found, it costs a system call per file.
+        :rtype: tuple of dicts of file name without extension to stat result or None,
+            one per extension"""
 
-        :rtype: list of file names"""
+        found = tuple({} for _ in exts)
+        with os.scandir(directory) as it:
+            for e in it:
+                for ext, names in zip(exts, found):
+                    if e.name.endswith(ext):
+                        names[e.name[:-len(ext)]] = e.stat() if stat else None
 
-        # list files in directory and sort them by name.
-        files = os.listdir(self._requests)
-        files.sort()
-        # iterate through files and select parameter names.
-        return [file.rstrip(".prm") for file in files if ".prm" in file]
+        return found
 
-    def _parse_param(self, fn):
+    def _index_dirs(self, stat_samples):
+        """Collects test names and existing request and sample files.
+
+        :param stat_samples: stat sample files too, only needed to skip unchanged tests.
+        :rtype: _Files of dicts of file names to stat results, see _scan"""
+
+        # request files are always read, their stat results are the cache keys.
+        params, req_content = self._scan(self._requests, (".prm", ".cnt"))
+        sample_cnt, sample_snh = self._scan(self._samples, (".cnt", ".snh"), stat_samples)
+
+        return _Files(params, req_content, sample_cnt, sample_snh)
+
+    def _parse_param(self, fn, st):
         """Compares response contents with a sample.
 
         :param fn: destination file name.
+        :param st: stat result of the parameters file, see _scan.
         :rtype: tuple of request type, URI and headers"""
 
-        # read request parameters.
-        j = json.loads(self._read_from_file(
-            os.path.join(self._requests, fn + ".prm")))
+        # read request parameters, unchanged files are not read again.
+        return self._read_cached(self._req_prefix + fn + ".prm", _load_prm, st)
+
+    def _read_request(self, name, index):
+        """Reads request parameters and contents of a test.
+
+        :param name: test name.
+        :param index: tests to run and their files, see _Index.
+        :rtype: tuple of request type, URI, headers and contents bytes"""
 
-        return j["Method"], j["URI"], j.get("Headers")
+        method, uri, headers = self._parse_param(name, index.params[name])
+        # encode contents like http.client encodes str bodies, the same for both backends.
+        content = self._get_request_content(name, index.req_content).encode("iso-8859-1")
 
-    def run(self):
-        """Run tests, get results, compare them to samples and check for errors."""
+        return method, uri, headers, content
+
+    def _process_response(self, name, status, headers, content, index):
+        """Saves a response and compares it to samples.
+
+        :param name: test name.
+        :param status: response status.
+        :param headers: response headers.
+        :param content: response contents bytes.
+        :param index: tests to run and their files, see _Index.
+        :rtype: True if the response matches samples"""
+
+        # contents are kept as raw bytes.
+        files = [
+            (self._res_prefix + name + ".cnt", content),
+            (self._res_prefix + name + ".snh", self._dumps({
+                "Status": status,
+                "Headers": headers,
+            })),
+        ]
+        ok, make_snh, make_cnt = self._check_sample(name, status, headers, content, index)
+        # missing samples are made from the response, headers are left for the user to add.
+        if make_snh:
+            files.append((self._smp_prefix + name + ".snh", self._dumps({"Status": status})))
+        if make_cnt:
+            files.append((self._smp_prefix + name + ".cnt", content))
+        self._save_batch(files)
+
+        return ok
+
+    def _do_one(self, name, index):
+        """Runs a single test: reads its request, sends it and compares the response to samples.
+
+        :param name: test name.
+        :param index: tests to run and their files, see _Index.
+        :rtype: True if the response matches samples"""
+
+        res = self._send_request(*self._read_request(name, index))
+
+        return self._process_response(name, *res, index)
+
+    async def _do_one_async(self, client, name, index):
+        """Runs a single test like _do_one, sending the request with httpx.
+
+        File work is done in worker threads so that it does not block other requests.
+
+        :param client: httpx client shared by all tests, see _run_async.
+        :param name: test name.
+        :param index: tests to run and their files, see _Index.
+        :rtype: True if the response matches samples"""
+
+        req = await asyncio.to_thread(self._read_request, name, index)
+        res = await self._send_request_async(client, *req)
+
+        return await asyncio.to_thread(self._process_response, name, *res, index)
+
+    async def _run_async(self, index):
+        """Sends all requests at once with httpx and reports results in test name order.
+
+        :param index: tests to run and their files, see _Index."""
+
+        # there is no timeout, as requests does by default.
+        client = httpx.AsyncClient(
+            http2=HTTP2, limits=httpx.Limits(max_connections=MAX_CONNECTIONS), timeout=None)
+        # send only the headers given in request parameters, as a bare request would.
+        client.headers.clear()
+        # do not keep cookies between tests, see _send_request_async.
+        client.cookies.jar.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        async with client:
+            tasks = [None if name in index.skipped
+                     else asyncio.ensure_future(self._do_one_async(client, name, index))
+                     for name in index.names]
+            error = None
+            # results are reported in a fixed order, so output and errors.txt are diffable.
+            for name, task in zip(index.names, tasks):
+                try:
+                    ok = None if task is None else await task
+                except Exception as e:
+                    # the other tests are sent anyway, report them all before raising.
+                    error = error or e
+                    ok = False
+                self._report(name, ok)
+        if error is not None:
+            raise error
+
+    def run(self, skip_unchanged=False):
+        """Run tests, get results, compare them to samples and check for errors.
+
+        :param skip_unchanged: skip tests that passed last time and whose request and sample
+            files have not changed since. Changes on the server side are not detected for them."""
 
         # at the start of a new test remove old errors.
         self._remove_errors()
-        # iterate through file names, get corresponding data, do requests and compare results.
-        for name in self._get_names():
-            method, uri, headers = self._parse_param(name)
-            req_content = self._get_request_content(name)
-            res_status, res_headers, res_content = self._send_request(
-                method, uri, headers, req_content, name)
+        # list directories once instead of checking every file separately.
+        files = self._index_dirs(skip_unchanged)
+        # the state is read in every run, so tests that do not pass are dropped from it.
+        state = self._load_state()
+        skipped = set()
+        if skip_unchanged:
+            # tests that are still unchanged are skipped, the rest are run again.
+            skipped = {
+                name for name in files.params
+                if name in state and state[name] == self._get_stamps(name, files)
+            }
+        index = _Index(
+            sorted(files.params), skipped, files.params, files.req_content, files.sample_cnt,
+            self._load_sample_headers(files.params.keys() - skipped, files.sample_snh))
+        # tests are independent and network-bound, so send them concurrently.
+        try:
+            # asyncio.run can not be called from a running event loop, e.g. in Jupyter.
+            if self._use_httpx and not self._in_event_loop():
+                asyncio.run(self._run_async(index))
+            else:
+                self._run_threads(index)
+        finally:
+            self._flush_errors()
+            self._save_state(state, skipped, files, skip_unchanged)
+            self._passed.clear()
+
+    @staticmethod
+    def _in_event_loop():
+        """Checks whether an event loop is running in the current thread."""
 
-            if not self._check_sample_headers(name, res_status, res_headers):
-                self._write_err(name)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+
+        return True
+
+    @staticmethod
+    def _get_stamps(name, files):
+        """Gets modification times and sizes of test files.
+
+        Files written within the same clock tick share a modification time, the size tells
+        apart most of them.
 
-                continue
+        :param name: test name.
+        :param files: existing files, see _index_dirs.
+        :rtype: list of modification time and size pairs, None for missing files"""
 
-            if not self._check_sample_contents(name, res_content):
-                self._write_err(name)
+        # the order is part of the saved state, so fields are listed by name.
+        found = (files.params, files.req_content, files.sample_cnt, files.sample_snh)
 
-                continue
+        return [[st.st_mtime_ns, st.st_size] if st else None
+                for st in (f.get(name) for f in found)]
 
-            print("Test #{} - OK".format(name))
+    def _load_state(self):
+        """Reads files modification times and sizes of tests passed last time.
+
+        :rtype: dict of test name to files modification times and sizes, see _get_stamps"""
+
+        try:
+            state = _loads(self._read_from_file(self._state_fn))
+        except (OSError, ValueError):
+            return {}
+        # a state file that is not an object is ignored like a broken one.
+        return state if isinstance(state, dict) else {}
+
+    def _save_state(self, state, skipped, files, record):
+        """Updates the state with results of this run and writes it if it has changed.
+
+        :param state: state read at the start of the run, see _load_state.
+        :param skipped: names of skipped tests.
+        :param files: existing files at the start of the run, see _index_dirs.
+        :param record: add tests passed in this run, sample files must have been stat'ed."""
+
+        passed = set(self._passed)
+        # tests that were run and did not pass must not be skipped next time.
+        new_state = {
+            name: stamps for name, stamps in state.items()
+            if name in skipped or name in passed
+        }
+        if record and passed:
+            # samples might have been made during the run, take their current stamps.
+            sample_cnt, sample_snh = self._scan(self._samples, (".cnt", ".snh"))
+            files = files._replace(sample_cnt=sample_cnt, sample_snh=sample_snh)
+            for name in passed:
+                new_state[name] = self._get_stamps(name, files)
+        if new_state != state:
+            self._save_batch(((self._state_fn, self._dumps(new_state)),))
+
+    def _run_threads(self, index):
+        """Sends requests from a pool of threads and reports results in test name order.
+
+        :param index: tests to run and their files, see _Index."""
+
+        error = None
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futs = [None if name in index.skipped else ex.submit(self._do_one, name, index)
+                    for name in index.names]
+            # results are reported in a fixed order, so output and errors.txt are diffable.
+            for name, fut in zip(index.names, futs):
+                try:
+                    ok = None if fut is None else fut.result()
+                except Exception as e:
+                    # the other tests are sent anyway, report them all before raising.
+                    error = error or e
+                    ok = False
+                self._report(name, ok)
+        if error is not None:
+            raise error
+
+    def _report(self, name, ok):
+        """Prints a test result, failures are also written to errors.txt.
+
+        :param name: test name.
+        :param ok: True if the test passed, None if it was skipped."""
+
+        if ok is None:
+            print("Test #{} - SKIP".format(name))
+
+            return
+
+        if not ok:
+            self._write_err(name)
+
+            return
+
+        self._passed.append(name)
+        print("Test #{} - OK".format(name))
 
     def _write_err(self, name):
-        """Writes given error to errors.txt
+        """Writes given error to errors.txt, see _flush_errors.
 
         :param name: name of a test that contains an error."""
 
         # print to std out.
         msg = "Test #{} - FAIL\n".format(name)
         print(msg, end="")
-        # append to file.
-        self._save_to_file(os.path.join(self._errors, "errors.txt"), msg, "a")
+        # buffer for the file.
+        with self._err_lock:
+            self._err_buf.append(msg)
+
+    def _flush_errors(self):
+        """Appends buffered errors to errors.txt with a single write."""
+
+        with self._err_lock:
+            if self._err_buf:
+                self._save_to_file(self._errors_fn, "".join(self._err_buf), "a")
+                self._err_buf.clear()
 
     def _remove_errors(self):
         """Removes errors.txt if exist."""
 
         try:
-            os.remove(os.path.join(self._errors, "errors.txt"))
+            os.remove(self._errors_fn)
         except OSError:
             pass